@@ -15,12 +15,16 @@ Usage:
 
 """
 import sys
+import re
 import json
 import glob
 import subprocess
 import shutil
 import os
 import tempfile
+import time
+import socket
+import gc
 from optparse import OptionParser
 
 import idaapi
@@ -37,6 +41,9 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# exit code of a cancelled commandline run, same value in ida_batch_jobqueue.EXIT_CANCELLED
+EXIT_CANCELLED = 2
+
 
 class IdaLocation(object):
     """ Wrap idautils Function
@@ -130,6 +137,127 @@ class IdaLocation(object):
         return stack_size, stack_vars
 
 
+class DecompiledOutput(object):
+    """ Merge the output of several decompile_many calls into one file
+
+        decompile_many writes a preamble (banner, includes), declaration blocks (a //---- separator
+        followed by a title like '// Function declarations') and the functions, each starting with
+        '//----- (<address>) ----', followed by a '// ALL OK, <n> function(s) ...' footer.
+        chunks are merged into one preamble, one set of declaration blocks, all functions and one footer.
+        declaration blocks are merged by complete declarations, a multi-line initializer is one entry.
+    """
+    FUNCTION_START = '//----- ('
+    SEPARATOR = '//-----'
+    FOOTER = re.compile(r'^// (ALL OK, )?(\d+) function\(s\) have been successfully decompiled')
+
+    def __init__(self):
+        self.preamble = None
+        self.sections = []  # [separator, title, lines, seen declarations]
+        self.decompiled = 0
+        self.footers = 0
+        self.all_ok = True
+
+    def _get_section(self, separator, title):
+        for section in self.sections:
+            if section[1] == title:
+                return section, False
+        section = [separator, title, [], set()]
+        self.sections.append(section)
+        return section, True
+
+    @staticmethod
+    def _declarations(lines):
+        """ split the lines of a declaration block into complete declarations (lists of lines)
+
+            a declaration ends with ';' outside of braces, comments and preprocessor lines
+            outside of braces stand on their own. blank lines between declarations are dropped.
+        """
+        declarations = []
+        current = []
+        depth = 0
+        for line in lines:
+            if not current and not line.strip():
+                continue
+            current.append(line)
+            depth += line.count('{') - line.count('}')
+            text = line.strip()
+            if depth <= 0 and (text.endswith(';') or text.startswith('//') or text.startswith('#')):
+                declarations.append(current)
+                current = []
+                depth = 0
+        if current:
+            declarations.append(current)
+        return declarations
+
+    def _merge_block(self, section, new_section, lines):
+        if new_section:
+            section[2].extend(lines)
+        for declaration in self._declarations(lines):
+            key = ''.join(declaration)
+            if not new_section and key not in section[3]:
+                # declarations only the later chunk knows about, keep them in the block
+                while section[2] and not section[2][-1].strip():
+                    section[2].pop()
+                section[2].extend(declaration)
+            section[3].add(key)
+
+    def add_chunk(self, path, body):
+        """ merge the header of chunk file path, append its functions to the open file body
+        """
+        preamble = []
+        separator = section = None
+        new_section = in_body = False
+        block = []
+        with open(path, 'r') as f:
+            for line in f:
+                m = self.FOOTER.match(line)
+                if m:
+                    self.footers += 1
+                    self.decompiled += int(m.group(2))
+                    self.all_ok &= bool(m.group(1))
+                    continue
+                if not in_body and section and (line.startswith(self.SEPARATOR)):
+                    # end of a declaration block, also the start of the functions
+                    self._merge_block(section, new_section, block)
+                    section = None
+                    block = []
+                if in_body or line.startswith(self.FUNCTION_START):
+                    in_body = True
+                    body.write(line)
+                elif line.startswith(self.SEPARATOR):
+                    separator = line
+                elif separator:
+                    # title line of a declaration block
+                    section, new_section = self._get_section(separator, line)
+                    separator = None
+                elif section:
+                    block.append(line)
+                else:
+                    preamble.append(line)
+        if section:
+            self._merge_block(section, new_section, block)
+        if self.preamble is None:
+            self.preamble = preamble
+
+    def write(self, outfile, body_path):
+        with open(outfile, 'w') as out:
+            out.writelines(self.preamble or [])
+            for separator, title, lines, _seen in self.sections:
+                while lines and not lines[-1].strip():
+                    lines.pop()
+                out.write(separator)
+                out.write(title)
+                out.writelines(lines)
+                out.write('\n')
+            if self.sections:
+                out.write('\n')
+            with open(body_path, 'r') as body:
+                shutil.copyfileobj(body, out)
+            if self.footers:
+                out.write("// %s%d function(s) have been successfully decompiled\n" % ("ALL OK, " if self.all_ok else "",
+                                                                                      self.decompiled))
+
+
 class IdaHelper(object):
     """ Namespace for ida helper functions
     """
@@ -146,8 +274,128 @@ class IdaHelper(object):
                 yield name
 
     @staticmethod
-    def decompile_full(outfile):
-        return idaapi.decompile_many(outfile, None, 0)
+    def decompile_full(outfile, funcs=None, chunk_size=64, progress=None, low_memory=False, max_rss=None):
+        """ decompile funcs (start addresses, default: all functions) to outfile
+
+            functions are passed to decompile_many in chunks of chunk_size. every chunk is written
+            to a temporary file and merged by DecompiledOutput, so outfile has a single header just
+            like the output of one decompile_many call. progress is reported and cancellation is
+            checked between chunks; a cancelled run keeps everything written so far and raises
+            BatchCancelled. an empty funcs list truncates outfile and returns False.
+            if nobody watches the run (no progress sink, cancel file, wait box or low_memory) the
+            functions are decompiled with a single decompile_many call instead.
+
+            low_memory flushes the decompiler caches after every chunk and reports the chunk's
+            peak rss. max_rss (bytes, implies low_memory) is a best effort limit that only steers
+            the chunk size, it does not cap memory: the chunk size is halved whenever the memory a
+            chunk added on top of the rss it started with does not fit below max_rss (this needs a
+            per chunk peak, linux only), and drops to a single function once the rss before a chunk
+            is already at max_rss (all platforms). a single function or the database itself can
+            still go above it.
+        """
+        low_memory = low_memory or bool(max_rss)
+        watched = progress and progress.is_watched()
+        if not low_memory and not watched and (funcs is None or len(funcs)):
+            return IdaHelper._decompile_once(outfile, funcs, progress)
+        funcs = list(idautils.Functions() if funcs is None else funcs)
+        if progress:
+            progress.start_image(os.path.split(outfile)[1], len(funcs))
+        flags = 0
+        if progress and progress.use_wait_box:
+            # we are showing our own wait box, do not stack the decompiler's dialog on top
+            flags |= getattr(idaapi, 'VDRUN_SILENT', 0x0004)
+        i = 0
+        max_chunk_peak = 0
+        output = DecompiledOutput()
+        # function bodies go to body_path until the merged header is known; both temp files
+        # are left behind as partial output if the process gets killed
+        chunk_path = outfile + '.chunk.tmp'
+        body_path = outfile + '.body.tmp'
+        body = open(body_path, 'w')
+        try:
+            while i < len(funcs):
+                if progress and progress.is_cancelled():
+                    raise BatchCancelled("cancelled after %d of %d functions" % (i, len(funcs)))
+                chunk = idaapi.eavec_t()
+                for ea in funcs[i:i + chunk_size]:
+                    chunk.push_back(ea)
+                if low_memory:
+                    peak_is_per_chunk = MemoryUsage.reset_peak()
+                    rss_before = MemoryUsage.rss()
+                if not idaapi.decompile_many(chunk_path, chunk, flags):
+                    logger.warning("[!] decompile_many failed for chunk at 0x%x" % funcs[i])
+                if os.path.exists(chunk_path):
+                    output.add_chunk(chunk_path, body)
+                    # a later decompile_many that fails without writing must not merge this chunk again
+                    os.remove(chunk_path)
+                if low_memory:
+                    peak = MemoryUsage.peak_rss()
+                    IdaHelper.flush_decompiler_caches(funcs[i:i + chunk_size])
+                    rss = MemoryUsage.rss()
+                    max_chunk_peak = max(max_chunk_peak, peak)
+                    logger.info("[i] chunk 0x%x (%d functions): peak rss %s, rss after flush %s" % (
+                                funcs[i], len(chunk), MemoryUsage.format(peak), MemoryUsage.format(rss)))
+                    if progress:
+                        progress.emit("chunk", chunk_size=len(chunk), peak_rss=peak, rss=rss)
+                    growth = peak - rss_before
+                    budget = max_rss - rss_before if max_rss else 0
+                    if max_rss and budget <= 0 and chunk_size > 1:
+                        # already at the limit before the chunk started, there is nothing left to halve into
+                        chunk_size = 1
+                        logger.warning("[!] rss %s was above the limit of %s before the chunk, reducing chunk size to 1" % (
+                                       MemoryUsage.format(rss_before), MemoryUsage.format(max_rss)))
+                    elif max_rss and peak_is_per_chunk and budget < growth and chunk_size > 1:
+                        chunk_size = max(1, chunk_size // 2)
+                        logger.warning("[!] chunk grew rss by %s, %s left below the limit, reducing chunk size to %d" % (
+                                       MemoryUsage.format(growth), MemoryUsage.format(budget), chunk_size))
+                    if max_rss and rss > max_rss:
+                        logger.warning("[!] rss after flush %s is above the limit of %s" % (
+                                       MemoryUsage.format(rss), MemoryUsage.format(max_rss)))
+                i += len(chunk)
+                if progress:
+                    progress.advance(len(chunk))
+        finally:
+            body.close()
+            if os.path.exists(chunk_path):
+                os.remove(chunk_path)
+            output.write(outfile, body_path)
+            os.remove(body_path)
+        if low_memory:
+            logger.info("[+] max chunk peak rss: %s" % MemoryUsage.format(max_chunk_peak))
+        if progress:
+            progress.image_done()
+        return bool(funcs)
+
+    @staticmethod
+    def _decompile_once(outfile, funcs, progress=None):
+        """ decompile funcs (None: all functions) with a single decompile_many call
+        """
+        chunk = None
+        if funcs is not None:
+            chunk = idaapi.eavec_t()
+            for ea in funcs:
+                chunk.push_back(ea)
+        total = len(list(idautils.Functions())) if funcs is None else len(funcs)
+        if progress:
+            progress.start_image(os.path.split(outfile)[1], total)
+        if not idaapi.decompile_many(outfile, chunk, 0):
+            logger.warning("[!] decompile_many failed for %r" % outfile)
+        if progress:
+            progress.advance(total)
+            progress.image_done()
+        return True
+
+    @staticmethod
+    def flush_decompiler_caches(funcs):
+        """ drop decompiled functions and other per-function state hexrays keeps around
+        """
+        if hasattr(idaapi, 'clear_cached_cfuncs'):
+            idaapi.clear_cached_cfuncs()
+        elif hasattr(idaapi, 'mark_cfunc_dirty'):
+            for ea in funcs:
+                idaapi.mark_cfunc_dirty(ea)
+        # cfunc_t wrappers still referenced from python keep their function alive
+        gc.collect()
 
     @staticmethod
     def annotate_xrefs():
@@ -201,6 +449,362 @@ class IdaHelper(object):
         print "[+] Done!"
 
 
+class FunctionFilter(object):
+    """ Select functions to decompile, a function has to match all given criteria
+
+        name         ... regex, searched in the function name
+        ranges       ... list of (start, end) addresses, end exclusive, matched against the function start
+        segments     ... list of segment names
+        exports_only ... only functions that are entry points/exports
+        min_size     ... minimum function size in bytes
+        max_size     ... maximum function size in bytes
+    """
+
+    def __init__(self, name=None, ranges=None, segments=None, exports_only=False, min_size=None, max_size=None):
+        self.name = name
+        self.name_re = re.compile(name) if name else None
+        self.ranges = ranges or []
+        self.segments = segments or []
+        self.exports_only = exports_only
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def __repr__(self, *args, **kwargs):
+        return "<FunctionFilter %r>" % self.as_args()
+
+    @staticmethod
+    def parse_ranges(values):
+        """ ['0x1000-0x2000,401000-402000', ...] -> [(0x1000, 0x2000), (0x401000, 0x402000)]
+        """
+        ranges = []
+        for value in values or []:
+            for r in value.split(','):
+                if not r.strip():
+                    continue
+                start, end = r.split('-', 1)
+                ranges.append((int(start.strip(), 16), int(end.strip(), 16)))
+        return ranges
+
+    @staticmethod
+    def parse_list(values):
+        return [v.strip() for value in values or [] for v in value.split(',') if v.strip()]
+
+    def is_empty(self):
+        return not (self.name_re or self.ranges or self.segments or self.exports_only
+                    or self.min_size or self.max_size)
+
+    def as_args(self, other_image=False):
+        """ commandline options to pass this filter on to child processes
+
+            other_image drops address ranges and segments, they describe the target binary only
+        """
+        args = []
+        if self.name:
+            args.append("--filter-name=%s" % self.name)
+        if self.ranges and not other_image:
+            args.append("--filter-range=%s" % ','.join("0x%x-0x%x" % r for r in self.ranges))
+        if self.segments and not other_image:
+            args.append("--filter-segment=%s" % ','.join(self.segments))
+        if self.exports_only:
+            args.append("--exports-only")
+        if self.min_size:
+            args.append("--min-size=%d" % self.min_size)
+        if self.max_size:
+            args.append("--max-size=%d" % self.max_size)
+        return args
+
+    def select(self, funcs):
+        exports = set(ea for _idx, _ordinal, ea, _name in idautils.Entries()) if self.exports_only else None
+        for ea in funcs:
+            if exports is not None and ea not in exports:
+                continue
+            if self.ranges and not any(start <= ea < end for start, end in self.ranges):
+                continue
+            if self.segments and SegName(ea) not in self.segments:
+                continue
+            if self.min_size or self.max_size:
+                _func = idaapi.get_func(ea)
+                size = _func.endEA - _func.startEA
+                if self.min_size and size < self.min_size:
+                    continue
+                if self.max_size and size > self.max_size:
+                    continue
+            if self.name_re and not self.name_re.search(GetFunctionName(ea) or ''):
+                continue
+            yield ea
+
+
+class MemoryUsage(object):
+    """ Namespace for process memory (rss) helpers, all values in bytes
+    """
+
+    @staticmethod
+    def _proc_status(key):
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) * 1024  # kB
+        return 0
+
+    @staticmethod
+    def _windows_counters():
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD),
+                        ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t),
+                        ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t),
+                        ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                 ctypes.byref(counters), counters.cb)
+        return counters
+
+    @staticmethod
+    def _max_rss():
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+    @staticmethod
+    def rss():
+        try:
+            if sys.platform.startswith('linux'):
+                return MemoryUsage._proc_status('VmRSS')
+            if sys.platform.startswith('win'):
+                return MemoryUsage._windows_counters().WorkingSetSize
+            return MemoryUsage._max_rss()
+        except Exception, e:
+            logger.debug("[i] rss not available: %r" % e)
+            return 0
+
+    @staticmethod
+    def peak_rss():
+        """ peak rss since the last reset_peak(), process lifetime peak where it cannot be reset
+        """
+        try:
+            if sys.platform.startswith('linux'):
+                return MemoryUsage._proc_status('VmHWM')
+            if sys.platform.startswith('win'):
+                return MemoryUsage._windows_counters().PeakWorkingSetSize
+            return MemoryUsage._max_rss()
+        except Exception, e:
+            logger.debug("[i] peak rss not available: %r" % e)
+            return 0
+
+    @staticmethod
+    def reset_peak():
+        """ returns True if peak_rss() now reports the peak since this call
+        """
+        if not sys.platform.startswith('linux'):
+            return False
+        try:
+            # resets VmHWM to the current rss, linux >= 4.0
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            return True
+        except IOError, e:
+            logger.debug("[i] cannot reset peak rss: %r" % e)
+            return False
+
+    @staticmethod
+    def format(size):
+        return "%.1f MB" % (size / (1024.0 * 1024))
+
+
+class BatchCancelled(Exception):
+    """ raised between chunks or images when a batch run was cancelled
+    """
+    pass
+
+
+class ProgressReporter(object):
+    """ Track batch progress and emit it as json events
+
+        sink        ... None, a file path (one json event per line, appended) or udp://<host>:<port>
+        cancel_file ... the run is cancelled as soon as this file exists
+        use_wait_box .. mirror progress into the IDA wait box and honor its cancel button
+    """
+
+    def __init__(self, sink=None, cancel_file=None, use_wait_box=False, images_total=0):
+        self.sink = sink
+        self.cancel_file = cancel_file
+        self.use_wait_box = use_wait_box
+        self.images_total = images_total
+        self.images_done = 0
+        self.image = None
+        self.functions_total = 0
+        self.functions_done = 0
+        self.image_started = self.started = time.time()
+        self.cancelled = False
+        self._fd = None
+        self._sock = None
+        self._addr = None
+        self._child_dir = None
+        if sink and sink.startswith("udp://"):
+            host, port = sink[len("udp://"):].rsplit(':', 1)
+            self._addr = (host, int(port))
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        elif sink:
+            self._fd = open(sink, 'a')
+        if self.use_wait_box:
+            idaapi.show_wait_box("Batch decompiling ...")
+
+    def is_watched(self):
+        """ True if someone looks at the progress or may cancel the run
+        """
+        return bool(self.sink or self.cancel_file or self.use_wait_box)
+
+    def add_images(self, n):
+        self.images_total += n
+
+    def start_image(self, name, functions_total):
+        self.image = name
+        self.functions_total = functions_total
+        self.functions_done = 0
+        self.image_started = time.time()
+        self.emit("image_start")
+
+    def advance(self, n=1):
+        self.functions_done += n
+        self.emit("progress")
+
+    def image_done(self, name=None):
+        self.images_done += 1
+        self.emit("image_done", image=name or self.image)
+
+    def stats(self):
+        elapsed = time.time() - self.image_started
+        throughput = self.functions_done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if throughput:
+            eta = (self.functions_total - self.functions_done) / throughput
+        return {'image': self.image,
+                'images_done': self.images_done,
+                'images_total': self.images_total,
+                'functions_done': self.functions_done,
+                'functions_total': self.functions_total,
+                'throughput': round(throughput, 2),  # functions/s
+                'eta': round(eta, 1) if eta is not None else None,  # seconds, current image
+                'elapsed': round(time.time() - self.started, 1)}
+
+    def emit(self, event, **kwargs):
+        data = self.stats()
+        data.update(kwargs)
+        data['event'] = event
+        data['time'] = time.time()
+        data['pid'] = os.getpid()  # child processes share the sink, one image each
+        self._write(data)
+
+    def _write(self, data):
+        line = json.dumps(data)
+        try:
+            if self._fd:
+                self._fd.write(line + '\n')
+                self._fd.flush()
+            elif self._sock:
+                self._sock.sendto(line, self._addr)
+        except (IOError, socket.error), e:
+            logger.warning("[!] failed to emit progress event: %r" % e)
+        if self.use_wait_box:
+            idaapi.replace_wait_box("Batch decompiling %s\n"
+                                    "images: %d/%d  functions: %d/%d\n"
+                                    "%.1f funcs/s  ETA: %s" % (data['image'],
+                                                               data['images_done'], data['images_total'],
+                                                               data['functions_done'], data['functions_total'],
+                                                               data['throughput'],
+                                                               "%ds" % data['eta'] if data['eta'] is not None else "-"))
+        logger.debug("[i] progress: %s" % line)
+
+    def child_channel(self):
+        """ returns (progress file, cancel file) for a local child process
+
+            the child writes its events to the progress file, watch_child() forwards them to our
+            sink and wait box and creates the cancel file once this run is cancelled.
+        """
+        if not self._child_dir:
+            self._child_dir = tempfile.mkdtemp(prefix="idbc_progress_")
+        child_sink = tempfile.mktemp(suffix='.jsonl', dir=self._child_dir)
+        return child_sink, os.path.join(self._child_dir, 'cancel')
+
+    def _forward_child_events(self, child_sink, offset):
+        try:
+            with open(child_sink, 'r') as f:
+                f.seek(offset)
+                for line in iter(f.readline, ''):
+                    if not line.endswith('\n'):
+                        # partially written, pick it up next time
+                        break
+                    offset += len(line)
+                    try:
+                        data = json.loads(line)
+                    except ValueError:
+                        continue
+                    if data.get('event') in ('finished', 'image_done'):
+                        # we send our own image_done for the child's image once it exits
+                        continue
+                    # the child only knows about its own image
+                    data['images_done'] = self.images_done
+                    data['images_total'] = self.images_total
+                    self._write(data)
+        except IOError:
+            pass
+        return offset
+
+    def watch_child(self, process, child_sink, child_cancel, interval=0.5):
+        """ wait for a child process started with child_channel() files, returns its returncode
+        """
+        offset = 0
+        while process.poll() is None:
+            time.sleep(interval)
+            offset = self._forward_child_events(child_sink, offset)
+            if self.is_cancelled() and not os.path.exists(child_cancel):
+                logger.warning("[!] asking child process %d to stop" % process.pid)
+                open(child_cancel, 'w').close()
+        self._forward_child_events(child_sink, offset)
+        if os.path.exists(child_sink):
+            os.remove(child_sink)
+        return process.returncode
+
+    def is_cancelled(self):
+        if self.cancelled:
+            return True
+        if self.cancel_file and os.path.exists(self.cancel_file):
+            logger.warning("[!] cancel file %r found" % self.cancel_file)
+            self.cancelled = True
+        elif self.use_wait_box:
+            if idaapi.IDA_SDK_VERSION >= 700:
+                self.cancelled = ida_kernwin.user_cancelled()
+            else:
+                self.cancelled = idaapi.wasBreak()
+        if self.cancelled:
+            self.emit("cancelled")
+        return self.cancelled
+
+    def finish(self):
+        self.emit("finished", cancelled=self.cancelled)
+        if self.use_wait_box:
+            idaapi.hide_wait_box()
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+        if self._child_dir:
+            shutil.rmtree(self._child_dir, ignore_errors=True)
+            self._child_dir = None
+
+
 class IdaDecompileBatchController(object):
     def __init__(self):
         self.is_windows = sys.platform.startswith('win')
@@ -218,6 +822,16 @@ class IdaDecompileBatchController(object):
         self.chk_decompile_imports = False
         self.chk_decompile_imports_recursive = False
         self.chk_decompile_alternative = False
+        self.progress_sink = None
+        self.cancel_file = None
+        self.chunk_size = 64
+        self.queue_path = None
+        self.queue_poll_interval = 5.0
+        self.queue_timeout = 0  # seconds without any worker activity in the queue, 0: wait forever
+        self.function_filter = None
+        self.chk_low_memory = False
+        self.max_rss = None  # bytes
+        self.cancelled = False  # last run() was cancelled
         # self.ida_home = idaapi.idadir(".")
         self.ida_home = GetIdaDirectory()
         # wait for ida analysis to finish
@@ -263,43 +877,136 @@ class IdaDecompileBatchController(object):
             idc.RunPlugin("hexarm", 0)
         logger.debug("[+] decompiler plugins loaded.")
 
-    def run(self):
+    def create_progress(self, images_total=0):
+        return ProgressReporter(sink=self.progress_sink, cancel_file=self.cancel_file,
+                                use_wait_box=not idaapi.cvar.batch, images_total=images_total)
+
+    def run(self, progress=None):
         files_decompiled = []
+        self.cancelled = False
         self._init_target()
+        owns_progress = progress is None
+        if owns_progress:
+            progress = self.create_progress()
+        progress.add_images(1)
 
-        if self.chk_decompile_imports:
-            self.init_tempdir()
-            if self.chk_decompile_imports_recursive:
+        try:
+            if self.chk_decompile_imports:
+                if self.chk_decompile_imports_recursive:
+                    pass
+                images = list(self.enumerate_import_images())
+                progress.add_images(len(images))
+                self.decompile_images(images, progress, files_decompiled)
+                if progress.is_cancelled():
+                    # do not touch the idb once the user asked us to stop
+                    raise BatchCancelled("cancelled after decompiling imports")
+
+            if self.chk_annotate_stackvar_size:
+                self.annotate_stack_variable_size()
+            if self.chk_annotate_xrefs:
+                self.annotate_xrefs()
+
+            if self.chk_decompile_alternative:
+                raise NotImplemented("Not yet implemented")
                 pass
-            for image_type, image_name, image_path in self.enumerate_import_images():
+            else:
+                if self.decompile_all(self.output_path, progress=progress):
+                    files_decompiled.append(self.target_file)
+        except BatchCancelled, bc:
+            logger.warning("[!] batch run cancelled: %s - partial output kept" % bc)
+            self.cancelled = True
+        finally:
+            if owns_progress:
+                progress.finish()
+
+        logger.info("[+] finished decompiling: %r" % files_decompiled)
+        logger.info("    output dir: %s"%self.output_path if self.output_path else self.target_dir)
+        return files_decompiled
+
+    def decompile_images(self, images, progress, files_decompiled):
+        """ decompile (image_type, image_name, image_path) items in child ida processes
+
+            runs them one by one on this box, or submits them all to the job queue and waits
+            for the workers if queue_path is set. appends to files_decompiled as images finish.
+        """
+        jobs = {}
+        queue_cancel = None
+        if self.queue_path:
+            # running jobs stop once this file exists, must be on the shared filesystem
+            queue_cancel = self.get_queue().cancel_path()
+        self.init_tempdir()
+        try:
+            for _type, image_name, image_path in images:
+                if progress.is_cancelled():
+                    raise BatchCancelled("cancelled before %r" % image_path)
                 try:
-                    self.exec_ida_batch_decompile(target = image_path, output = self.output_path,
-                                                  annotate_stackvar_size = self.chk_annotate_stackvar_size,
-                                                  annotate_xrefs = self.chk_annotate_xrefs,
-                                                  imports = self.chk_decompile_imports,
-                                                  recursive = self.chk_decompile_imports_recursive,
-                                                  experimental_decomile_cgraph = self.chk_decompile_alternative)
+                    job_id = self.exec_ida_batch_decompile(target=image_path, output=self.output_path,
+                                                           annotate_stackvar_size=self.chk_annotate_stackvar_size,
+                                                           annotate_xrefs=self.chk_annotate_xrefs,
+                                                           imports=self.chk_decompile_imports,
+                                                           recursive=self.chk_decompile_imports_recursive,
+                                                           experimental_decomile_cgraph=self.chk_decompile_alternative,
+                                                           cancel_file=queue_cancel,
+                                                           progress=progress)
+                    if self.queue_path:
+                        jobs[job_id] = (image_name, image_path)
+                        continue
                     files_decompiled.append(image_path)
                 except subprocess.CalledProcessError, cpe:
-                    logger.warning("[!] failed to decompile %r - %r" % (image_path, cpe))
-
+                    if cpe.returncode == EXIT_CANCELLED:
+                        logger.warning("[!] decompiling %r was cancelled - partial output kept" % image_path)
+                    else:
+                        logger.warning("[!] failed to decompile %r - %r" % (image_path, cpe))
+                progress.image_done(image_name)
+            if jobs:
+                self.wait_for_jobs(jobs, progress, files_decompiled, queue_cancel)
+        finally:
             self.remove_tempdir()
 
-        if self.chk_annotate_stackvar_size:
-            self.annotate_stack_variable_size()
-        if self.chk_annotate_xrefs:
-            self.annotate_xrefs()
+    def get_queue(self):
+        # pure python, lives next to this script
+        script_dir = os.path.dirname(self.my_path)
+        if script_dir not in sys.path:
+            sys.path.append(script_dir)
+        from ida_batch_jobqueue import JobQueue
+        return JobQueue(self.queue_path)
 
-        if self.chk_decompile_alternative:
-            raise NotImplemented("Not yet implemented")
-            pass
-        else:
-            self.decompile_all(self.output_path)
-            files_decompiled.append(self.target_file)
-
-        logger.info("[+] finished decompiling: %r" % files_decompiled)
-        logger.info("    output dir: %s"%self.output_path if self.output_path else self.target_dir)
-        return files_decompiled
+    def wait_for_jobs(self, jobs, progress, files_decompiled, queue_cancel):
+        """ wait for queued jobs, gives up after queue_timeout seconds without any worker activity in the queue
+        """
+        queue = self.get_queue()
+        pending = dict(jobs)
+        logger.debug("[+] waiting for %d queued jobs in %r" % (len(pending), self.queue_path))
+        while pending:
+            for job_id, (image_name, image_path) in pending.items():
+                result = queue.result(job_id)
+                if not result:
+                    continue
+                del pending[job_id]
+                if result.get('status') == 'done':
+                    files_decompiled.append(image_path)
+                elif result.get('status') == 'cancelled':
+                    logger.warning("[!] decompiling %r was cancelled - job %s" % (image_path, job_id))
+                else:
+                    logger.warning("[!] failed to decompile %r - job %s: %r" % (image_path, job_id, result))
+                progress.image_done(image_name)
+            if not pending:
+                break
+            if progress.is_cancelled():
+                # unclaimed jobs are dropped, running ones stop after their current chunk
+                open(queue_cancel, 'w').close()
+                queue.cancel(pending.keys())
+                raise BatchCancelled("cancelled while waiting for %d queued jobs" % len(pending))
+            idle = time.time() - (queue.last_activity(pending.keys()) or 0)
+            if self.queue_timeout and idle > self.queue_timeout:
+                logger.warning("[!] no worker activity in %r for %ds, giving up on %d jobs" % (
+                               self.queue_path, idle, len(pending)))
+                queue.cancel(pending.keys())
+                for job_id, (image_name, image_path) in pending.items():
+                    logger.warning("[!] failed to decompile %r - job %s timed out" % (image_path, job_id))
+                    progress.image_done(image_name)
+                return
+            time.sleep(self.queue_poll_interval)
 
     def annotate_stack_variable_size(self):
         logger.debug("[+] annotating function stack variables")
@@ -343,14 +1050,23 @@ class IdaDecompileBatchController(object):
                         yield ftype, name, fpath
                 except IOError: pass
 
-    def decompile_all(self, outfile=None):
+    def decompile_all(self, outfile=None, progress=None):
         outfile = self._get_suggested_output_filename(outfile or self.target_path)
         logger.warning(outfile)
         logger.debug("[+] trying to decompile %r as %r" % (self.target_file,
                                                            os.path.split(outfile)[1]))
-        IdaHelper.decompile_full(outfile)
+        funcs = None
+        if self.function_filter and not self.function_filter.is_empty():
+            funcs = list(self.function_filter.select(idautils.Functions()))
+            logger.info("[+] %r selected %d functions" % (self.function_filter, len(funcs)))
+            if not funcs:
+                # still truncate outfile, an old output must not look like the result of this run
+                logger.warning("[!] no functions match %r, writing empty %r" % (self.function_filter, outfile))
+        decompiled = IdaHelper.decompile_full(outfile, funcs=funcs, chunk_size=self.chunk_size, progress=progress,
+                                              low_memory=self.chk_low_memory, max_rss=self.max_rss)
         logger.debug("[+] finished decompiling %r as %r" % (self.target_file,
                                                             os.path.split(outfile)[1]))
+        return decompiled
 
     def _get_suggested_output_filename(self, target):
         # /a/b/c/d/e/bin.ext
@@ -372,11 +1088,13 @@ class IdaDecompileBatchController(object):
         return '%s.c' % os.path.join(root, fname)
 
     def exec_ida_batch_decompile(self, target, output, annotate_stackvar_size, annotate_xrefs, imports, recursive,
-                                 experimental_decomile_cgraph):
+                                 experimental_decomile_cgraph, progress_sink=None, cancel_file=None, progress=None):
         logger.debug("[+] batch decompile %r" % target)
         # todo: pass commandlines,
         # todo parse commandline
-        script_args = ['--output=%s' % output]
+        script_args = []
+        if output:
+            script_args.append('--output=%s' % output)
         if annotate_stackvar_size:
             script_args.append("--annotate-stackvar-size")
         if annotate_xrefs:
@@ -387,12 +1105,34 @@ class IdaDecompileBatchController(object):
             script_args.append("--recursive")
         if experimental_decomile_cgraph:
             script_args.append("--experimental-decompile-cgraph")
-
+        if self.function_filter:
+            # children decompile imports, not the image ranges and segments were given for
+            script_args += self.function_filter.as_args(other_image=True)
+        script_args.append("--chunk-size=%d" % self.chunk_size)
+        if self.chk_low_memory:
+            script_args.append("--low-memory")
+        if self.max_rss:
+            script_args.append("--max-rss=%d" % (self.max_rss // (1024 * 1024)))
+        child_sink = child_cancel = None
+        if progress and not self.queue_path:
+            # local child, progress watches it and forwards its events
+            child_sink, child_cancel = progress.child_channel()
+            progress_sink = progress_sink or child_sink
+            cancel_file = cancel_file or child_cancel
+        # the child reports functions of its own image, the caller keeps track of images
+        if progress_sink or self.progress_sink:
+            script_args.append("--progress=%s" % (progress_sink or self.progress_sink))
+        if cancel_file or self.cancel_file:
+            script_args.append("--cancel-file=%s" % (cancel_file or self.cancel_file))
+
+        if self.queue_path:
+            # workers quote and run it with their own ida, returns the job id
+            return self.get_queue().submit(target, script_args, ida64=self.is_ida64)
         script_args = ['\\"%s\\"' % a for a in script_args]
         command = "%s %s" % (self.my_path, ' '.join(script_args))
-        self._exec_ida_batch(target, command)
+        self._exec_ida_batch(target, command, progress=progress, child_sink=child_sink, child_cancel=child_cancel)
 
-    def _exec_ida_batch(self, target, command):
+    def _exec_ida_batch(self, target, command, progress=None, child_sink=None, child_cancel=None):
         # build exe path
         if self.is_windows:
             ida_exe = os.path.join(self.ida_home, 'idaw64.exe' if self.is_ida64 else 'idaw.exe')
@@ -412,7 +1152,14 @@ class IdaDecompileBatchController(object):
         logger.debug('[+] executing: %r' % cmd)
         #return 0
         # TODO: INSECURE!
-        return subprocess.check_call(' '.join(cmd), shell=True)
+        p = subprocess.Popen(' '.join(cmd), shell=True)
+        if progress and child_sink:
+            returncode = progress.watch_child(p, child_sink, child_cancel)
+        else:
+            returncode = p.wait()
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, ' '.join(cmd))
+        return returncode
 
 
 class TestEmbeddedChooserClass(Choose,Choose2):
@@ -475,6 +1222,14 @@ class DecompileBatchForm(Form):
 {FormChangeCb}
 <##Target    :{target}>
 <##OutputPath:{outputPath}>
+<##Job Queue :{queuePath}>
+<##Function Name RegEx:{filterName}>
+<##Address Ranges    :{filterRanges}>
+<##Segments          :{filterSegments}>
+<##Min Function Size :{filterMinSize}> <##Max Function Size:{filterMaxSize}>
+<##Exports only:{chkExportsOnly}>{cGroup3}>
+<##Chunk Size        :{chunkSize}> <##Max RSS (MB):{maxRss}>
+<##Low Memory (flush decompiler caches between chunks):{chkLowMemory}>{cGroup4}>
 <##Annotate StackVar Size:{chkAnnotateStackVars}>
 <##Annotate Func XRefs   :{chkAnnotateXrefs}>
 <##Process Imports       :{chkDecompileImports}>
@@ -489,10 +1244,20 @@ class DecompileBatchForm(Form):
 """, {
                           'target': Form.FileInput(swidth=50, open=True, value=idbctrl.target_path),
                           'outputPath': Form.DirInput(swidth=50, value=idbctrl.output_path),
+                          'queuePath': Form.DirInput(swidth=50, value=idbctrl.queue_path),
                           'cGroup1': Form.ChkGroupControl(("chkAnnotateStackVars", "chkAnnotateXrefs",
                                                            "chkDecompileImports",
                                                            "chkDecompileAlternative")),
                           'cGroup2': Form.ChkGroupControl(("chkDecompileImportsRecursive", )),
+                          'cGroup3': Form.ChkGroupControl(("chkExportsOnly", )),
+                          'cGroup4': Form.ChkGroupControl(("chkLowMemory", )),
+                          'chunkSize': Form.NumericInput(tp=Form.FT_DEC, value=idbctrl.chunk_size),
+                          'maxRss': Form.NumericInput(tp=Form.FT_DEC, value=0),
+                          'filterName': Form.StringInput(swidth=50),
+                          'filterRanges': Form.StringInput(swidth=50),
+                          'filterSegments': Form.StringInput(swidth=50),
+                          'filterMinSize': Form.NumericInput(tp=Form.FT_DEC, value=0),
+                          'filterMaxSize': Form.NumericInput(tp=Form.FT_DEC, value=0),
                           'FormChangeCb': Form.FormChangeCb(self.OnFormChange),
                           'btnLoad':  Form.ButtonInput(self.OnButtonLoad),
                           'btnProcessFiles': Form.ButtonInput(self.OnButtonProcess),
@@ -519,6 +1284,7 @@ class DecompileBatchForm(Form):
             return
 
         self.idbctrl.target = self.target.value
+        self.idbctrl.queue_path = self.GetControlValue(self.queuePath) or None
         outputPath = self.GetControlValue(self.outputPath)
         if outputPath == '' or os.path.exists(outputPath):
             self.idbctrl.output_path = outputPath
@@ -531,35 +1297,41 @@ class DecompileBatchForm(Form):
         self.idbctrl.chk_decompile_imports_recursive = self.chkDecompileImportsRecursive.checked
         self.idbctrl.chk_annotate_xrefs = self.chkAnnotateXrefs.checked
         self.idbctrl.chk_decompile_alternative = self.chkDecompileAlternative.checked
+        try:
+            self.idbctrl.function_filter = FunctionFilter(
+                name=self.GetControlValue(self.filterName) or None,
+                ranges=FunctionFilter.parse_ranges([self.GetControlValue(self.filterRanges)]),
+                segments=FunctionFilter.parse_list([self.GetControlValue(self.filterSegments)]),
+                exports_only=self.chkExportsOnly.checked,
+                min_size=self.GetControlValue(self.filterMinSize) or None,
+                max_size=self.GetControlValue(self.filterMaxSize) or None)
+        except (ValueError, re.error), e:
+            logger.warning("[!] Aborting. Invalid function filter: %r" % e)
+            return
+        self.idbctrl.chunk_size = max(1, self.GetControlValue(self.chunkSize))
+        self.idbctrl.chk_low_memory = self.chkLowMemory.checked
+        self.idbctrl.max_rss = self.GetControlValue(self.maxRss) * 1024 * 1024 or None
         logger.debug("[+] config updated")
 
         files_decompiled = []
-        decompile_main_binary = False
+        selected = list(self.EChooser.getSelected())
+        images = [item for item in selected if item[2] is not self.idbctrl.target_path]
+        decompile_main_binary = len(images) != len(selected)
+        progress = self.idbctrl.create_progress(images_total=len(images))
 
-        self.idbctrl.init_tempdir()
-        for _type, name, image_path in self.EChooser.getSelected():
-            if image_path is self.idbctrl.target_path:
-                decompile_main_binary = True
-                continue
-            try:
-                self.idbctrl.exec_ida_batch_decompile(target=image_path, output=outputPath,
-                                              annotate_stackvar_size=self.idbctrl.chk_annotate_stackvar_size,
-                                              annotate_xrefs=self.idbctrl.chk_annotate_xrefs,
-                                              imports=self.idbctrl.chk_decompile_imports,
-                                              recursive=self.idbctrl.chk_decompile_imports_recursive,
-                                              experimental_decomile_cgraph=self.idbctrl.chk_decompile_alternative)
-                files_decompiled.append(image_path)
-            except subprocess.CalledProcessError, cpe:
-                logger.warning("[!] failed to decompile %r - %r" % (image_path, cpe))
-
-        self.idbctrl.remove_tempdir()
-        ## process current file
-        if decompile_main_binary:
-            # well, loop here even though we know it can only
-            logger.debug("[+] decompiling current file...")
-            files_decompiled += self.idbctrl.run()  # decompile main binary
-            logger.info("[+] finished decompiling: %r" % files_decompiled)
-            logger.info("    output dir: %s" % self.idbctrl.output_path if self.idbctrl.output_path else self.idbctrl.target_dir)
+        try:
+            self.idbctrl.decompile_images(images, progress, files_decompiled)
+            ## process current file
+            if decompile_main_binary and not progress.is_cancelled():
+                # well, loop here even though we know it can only
+                logger.debug("[+] decompiling current file...")
+                files_decompiled += self.idbctrl.run(progress=progress)  # decompile main binary
+        except BatchCancelled, bc:
+            logger.warning("[!] batch run cancelled: %s - partial output kept" % bc)
+        finally:
+            progress.finish()
+        logger.info("[+] finished decompiling: %r" % files_decompiled)
+        logger.info("    output dir: %s" % self.idbctrl.output_path if self.idbctrl.output_path else self.idbctrl.target_dir)
 
     def OnButtonLoad(self, code=0):
         self.Close(0)
@@ -574,6 +1346,7 @@ class DecompileBatchForm(Form):
         if fid == INIT:
             self.EnableField(self.target, False)
             self.EnableField(self.outputPath, True)
+            self.EnableField(self.queuePath, True)
             self.EnableField(self.chkDecompileAlternative, False)
 
         elif fid == BTN_OK:
@@ -591,6 +1364,10 @@ class DecompileBatchForm(Form):
             self.chkDecompileAlternative.checked = not self.chkDecompileAlternative.checked
         elif fid == self.chkAnnotateXrefs.id:
             self.chkAnnotateXrefs.checked = not self.chkAnnotateXrefs.checked
+        elif fid == self.chkExportsOnly.id:
+            self.chkExportsOnly.checked = not self.chkExportsOnly.checked
+        elif fid == self.chkLowMemory.id:
+            self.chkLowMemory.checked = not self.chkLowMemory.checked
 
         return False
 
@@ -707,6 +1484,32 @@ def PLUGIN_ENTRY(mode=None):
             parser.add_option("-Z", "--experimental-decompile-cgraph",
                               action="store_true", default=False,
                               help="[experimental] decompile funcs referenced in calltree manually")
+            parser.add_option("-P", "--progress", dest="progress",
+                              help="append json progress events to this file or send them to udp://<host>:<port>")
+            parser.add_option("-C", "--cancel-file", dest="cancel_file",
+                              help="stop cleanly after the current chunk of functions (--chunk-size) once this file exists")
+            parser.add_option("--filter-name", dest="filter_name",
+                              help="only decompile functions whose name matches this regex")
+            parser.add_option("--filter-range", dest="filter_range", action="append",
+                              help="only decompile functions starting in <start>-<end> (hex, end exclusive, comma separated)")
+            parser.add_option("--filter-segment", dest="filter_segment", action="append",
+                              help="only decompile functions in these segments (comma separated)")
+            parser.add_option("--exports-only", action="store_true", default=False,
+                              help="only decompile exported functions/entry points")
+            parser.add_option("--min-size", dest="min_size", type="int",
+                              help="only decompile functions of at least this many bytes")
+            parser.add_option("--max-size", dest="max_size", type="int",
+                              help="only decompile functions of at most this many bytes")
+            parser.add_option("--chunk-size", dest="chunk_size", type="int", default=64,
+                              help="number of functions passed to the decompiler at once")
+            parser.add_option("--low-memory", action="store_true", default=False,
+                              help="flush decompiler caches between chunks and report peak rss per chunk")
+            parser.add_option("--max-rss", dest="max_rss", type="int",
+                              help="best effort memory limit in MB, shrinks chunks to stay below it but does not cap memory (implies --low-memory)")
+            parser.add_option("-Q", "--queue", dest="queue",
+                              help="submit child images to this shared job queue directory instead of running them here")
+            parser.add_option("--queue-timeout", dest="queue_timeout", type="int", default=0,
+                              help="give up on queued jobs after this many seconds without any worker activity in the queue (0: wait forever)")
 
             options, args = parser.parse_args(idc.ARGV[1:])
             # set options
@@ -716,9 +1519,27 @@ def PLUGIN_ENTRY(mode=None):
             idbctrl.chk_decompile_imports = options.imports
             idbctrl.chk_decompile_imports_recursive = options.recursive
             idbctrl.chk_decompile_alternative = options.experimental_decompile_cgraph
+            idbctrl.progress_sink = options.progress
+            idbctrl.cancel_file = options.cancel_file
+            idbctrl.queue_path = options.queue
+            idbctrl.queue_timeout = options.queue_timeout
+            idbctrl.chunk_size = max(1, options.chunk_size)
+            idbctrl.chk_low_memory = options.low_memory
+            idbctrl.max_rss = options.max_rss * 1024 * 1024 if options.max_rss else None
+            try:
+                idbctrl.function_filter = FunctionFilter(name=options.filter_name,
+                                                         ranges=FunctionFilter.parse_ranges(options.filter_range),
+                                                         segments=FunctionFilter.parse_list(options.filter_segment),
+                                                         exports_only=options.exports_only,
+                                                         min_size=options.min_size,
+                                                         max_size=options.max_size)
+            except (ValueError, re.error), e:
+                logger.error("[!] Aborting. Invalid function filter: %r" % e)
+                idc.Exit(1)
             # set all the idbctrl checkboxes and files
             idbctrl.run()
-            idc.Exit(0)
+            # the parent process or queue worker must not take a cancelled run for a finished one
+            idc.Exit(EXIT_CANCELLED if idbctrl.cancelled else 0)
             # return
 
         logger.debug("[+] Mode: commandline w/o args")
@@ -0,0 +1,384 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Author : <github.com/tintinweb>
+"""
+IdaBatchDecompile shared-filesystem job queue
+
+The controller (ida_batch_decompile.py --queue=<dir>) writes job descriptors into a shared
+directory, workers on any node claim them through lease files, run ida in batch mode and
+write the result back. Does not depend on idaapi, workers run with a plain python interpreter.
+
+Layout:
+
+* <queue>/jobs/<id>.json               ... job descriptor (target, script args), written by the controller
+* <queue>/leases/<id>.<attempt>.lease  ... claimed job, kept alive by touching it (mtime)
+* <queue>/results/<id>.json            ... final status, written by the worker
+* <queue>/cancel/<run>                 ... created by the controller to stop the running jobs of a run
+
+Leases are created with link(2), which is atomic on local filesystems and NFS. An expired lease
+is never removed; it is recovered by claiming the next attempt number, so only one worker can win.
+
+Usage:
+
+* worker: python ida_batch_jobqueue.py worker --queue=<dir> --ida-home=<path_to_ida>
+* submit: python ida_batch_jobqueue.py submit --queue=<dir> <target> -- [--option1 ...]
+* status: python ida_batch_jobqueue.py status --queue=<dir>
+
+"""
+import sys
+import json
+import os
+import time
+import uuid
+import socket
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# exit code of a cancelled ida_batch_decompile.py run, same value as ida_batch_decompile.EXIT_CANCELLED
+EXIT_CANCELLED = 2
+
+
+class JobQueue(object):
+    """ Shared directory job queue with lease based claiming
+    """
+
+    def __init__(self, path, lease_ttl=300, max_attempts=3):
+        self.path = path
+        self.lease_ttl = lease_ttl
+        self.max_attempts = max_attempts
+        self.jobs_dir = os.path.join(path, 'jobs')
+        self.leases_dir = os.path.join(path, 'leases')
+        self.results_dir = os.path.join(path, 'results')
+        self.cancel_dir = os.path.join(path, 'cancel')
+        for d in (self.jobs_dir, self.leases_dir, self.results_dir, self.cancel_dir):
+            try:
+                os.makedirs(d)
+            except OSError:
+                if not os.path.isdir(d):
+                    raise
+
+    @staticmethod
+    def _unique_suffix():
+        return '%s.%d.%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+    def _write_atomic(self, path, data):
+        tmp = '%s.%s.tmp' % (path, self._unique_suffix())
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _job_path(self, job_id):
+        return os.path.join(self.jobs_dir, '%s.json' % job_id)
+
+    def _result_path(self, job_id):
+        return os.path.join(self.results_dir, '%s.json' % job_id)
+
+    def _lease_path(self, job_id, attempt):
+        return os.path.join(self.leases_dir, '%s.%d.lease' % (job_id, attempt))
+
+    def submit(self, target, script_args, ida64=False):
+        """ write a job descriptor, returns the job id
+        """
+        job_id = '%s-%s' % (time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:12])
+        self._write_atomic(self._job_path(job_id), {'id': job_id,
+                                                    'target': target,
+                                                    'script_args': script_args,
+                                                    'ida64': ida64,
+                                                    'lease_ttl': self.lease_ttl,
+                                                    'max_attempts': self.max_attempts,
+                                                    'submitted': time.time()})
+        logger.debug("[+] submitted job %s for %r" % (job_id, target))
+        return job_id
+
+    def jobs(self):
+        return sorted(f[:-len('.json')] for f in os.listdir(self.jobs_dir) if f.endswith('.json'))
+
+    def job(self, job_id):
+        return self._read(self._job_path(job_id))
+
+    def result(self, job_id):
+        return self._read(self._result_path(job_id))
+
+    def finished(self):
+        """ ids of all jobs with a result, one listing of the results directory
+        """
+        return set(f[:-len('.json')] for f in os.listdir(self.results_dir) if f.endswith('.json'))
+
+    def lease_index(self):
+        """ job id -> sorted attempts of all leases, one listing of the leases directory
+        """
+        index = {}
+        for f in os.listdir(self.leases_dir):
+            if not f.endswith('.lease'):
+                continue
+            job_id, _, attempt = f[:-len('.lease')].rpartition('.')
+            try:
+                index.setdefault(job_id, []).append(int(attempt))
+            except ValueError:
+                pass
+        for attempts in index.values():
+            attempts.sort()
+        return index
+
+    def pending(self):
+        """ jobs without a result, claimed or not
+        """
+        finished = self.finished()
+        return [job_id for job_id in self.jobs() if job_id not in finished]
+
+    def attempts(self, job_id, index=None):
+        """ sorted lease attempts of job_id, pass a lease_index() when asking for many jobs
+        """
+        if index is None:
+            index = self.lease_index()
+        return index.get(job_id, [])
+
+    def lease(self, job_id, attempt):
+        return self._read(self._lease_path(job_id, attempt))
+
+    def cancel_path(self, run_id=None):
+        """ shared cancel file for a run, pass it to the jobs as --cancel-file and create it to stop them
+        """
+        return os.path.join(self.cancel_dir, run_id or uuid.uuid4().hex)
+
+    def last_activity(self, job_ids):
+        """ newest submit or result time of job_ids or lease heartbeat of any unfinished job in the queue,
+            None if there are none. workers busy with other runs' jobs count as activity so that a run
+            queued behind them does not time out.
+        """
+        paths = []
+        for job_id in job_ids:
+            paths.append(self._job_path(job_id))
+            paths.append(self._result_path(job_id))
+        finished = self.finished()
+        for job_id, attempts in self.lease_index().items():
+            if job_id not in finished and attempts:
+                paths.append(self._lease_path(job_id, attempts[-1]))
+        mtimes = []
+        for path in paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                pass
+        return max(mtimes) if mtimes else None
+
+    def lease_expired(self, job_id, attempt):
+        path = self._lease_path(job_id, attempt)
+        info = self._read(path) or {}
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return True
+        return mtime + info.get('ttl', self.lease_ttl) < time.time()
+
+    def _acquire(self, job_id, attempt, worker_id, ttl):
+        path = self._lease_path(job_id, attempt)
+        tmp = '%s.%s.tmp' % (path, self._unique_suffix())
+        with open(tmp, 'w') as f:
+            json.dump({'worker': worker_id, 'attempt': attempt, 'ttl': ttl, 'claimed': time.time()}, f)
+        try:
+            try:
+                os.link(tmp, path)
+            except OSError:
+                pass
+            # link() may report failure over NFS although it succeeded, trust the link count
+            return os.stat(tmp).st_nlink == 2
+        finally:
+            os.unlink(tmp)
+
+    def claim(self, worker_id):
+        """ claim the next unleased job or recover an expired one
+
+            returns (job, attempt) or (None, None)
+        """
+        index = self.lease_index()
+        for job_id in self.pending():
+            job = self.job(job_id)
+            if not job:
+                continue
+            attempts = self.attempts(job_id, index)
+            if attempts:
+                if not self.lease_expired(job_id, attempts[-1]):
+                    continue
+                if attempts[-1] >= job.get('max_attempts', self.max_attempts):
+                    logger.warning("[!] job %s: lease expired %d times, giving up" % (job_id, attempts[-1]))
+                    self.complete(job_id, attempts[-1], 'failed', worker_id, error='lease expired')
+                    continue
+                logger.warning("[!] job %s: recovering expired lease of attempt %d" % (job_id, attempts[-1]))
+            attempt = attempts[-1] + 1 if attempts else 1
+            if not self._acquire(job_id, attempt, worker_id, job.get('lease_ttl', self.lease_ttl)):
+                continue
+            if os.path.exists(self._result_path(job_id)):
+                # finished or cancelled while we were claiming it
+                continue
+            logger.debug("[+] %s claimed job %s (attempt %d)" % (worker_id, job_id, attempt))
+            return job, attempt
+        return None, None
+
+    def heartbeat(self, job_id, attempt):
+        """ keep a lease alive, returns False if it was taken over by a newer attempt
+        """
+        if os.path.exists(self._lease_path(job_id, attempt + 1)):
+            return False
+        try:
+            os.utime(self._lease_path(job_id, attempt), None)
+        except OSError:
+            return False
+        return True
+
+    def complete(self, job_id, attempt, status, worker_id, **kwargs):
+        result = {'id': job_id, 'status': status, 'attempt': attempt,
+                  'worker': worker_id, 'finished': time.time()}
+        result.update(kwargs)
+        self._write_atomic(self._result_path(job_id), result)
+
+    def cancel(self, job_ids, worker_id='controller'):
+        """ mark jobs that no worker has claimed yet as cancelled, running jobs are left alone
+        """
+        finished = self.finished()
+        index = self.lease_index()
+        for job_id in job_ids:
+            if job_id not in finished and not self.attempts(job_id, index):
+                self.complete(job_id, 0, 'cancelled', worker_id)
+
+
+class JobQueueWorker(object):
+    """ Claim jobs from a JobQueue and run them with a local ida
+    """
+
+    def __init__(self, queue, ida_home=None, ida_exe=None, script=None, poll_interval=5.0, worker_id=None):
+        self.queue = queue
+        self.ida_home = ida_home
+        self.ida_exe = ida_exe
+        self.script = script or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ida_batch_decompile.py')
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id or '%s-%d' % (socket.gethostname(), os.getpid())
+        self.is_windows = sys.platform.startswith('win')
+
+    def get_ida_exe(self, ida64):
+        if self.ida_exe:
+            return self.ida_exe
+        if self.is_windows:
+            return os.path.join(self.ida_home, 'idaw64.exe' if ida64 else 'idaw.exe')
+        return os.path.join(self.ida_home, 'idal64' if ida64 else 'idal')
+
+    def get_command(self, job, temp_path):
+        '''
+        see IdaDecompileBatchController._exec_ida_batch
+        -B  ..  Batch mode
+        -M  ..  disable mouse
+        -c  ..  create new database
+        -o  ..  database output path
+        -S  ..  execute script
+        '''
+        script_args = ['\\"%s\\"' % a for a in job['script_args']]
+        command = "%s %s" % (self.script, ' '.join(script_args))
+        return ' '.join([self.get_ida_exe(job.get('ida64')), '-B', '-M', '-c', '-o"%s"' % temp_path,
+                         '-S"%s"' % command, '"' + job['target'] + '"'])
+
+    def run_job(self, job, attempt):
+        temp_path = tempfile.mkdtemp(prefix="idbc_")
+        cmd = self.get_command(job, temp_path)
+        logger.debug('[+] job %s: executing: %r' % (job['id'], cmd))
+        started = time.time()
+        heartbeat = min(self.poll_interval, job.get('lease_ttl', self.queue.lease_ttl) / 3.0)
+        try:
+            # TODO: INSECURE! (same as IdaDecompileBatchController._exec_ida_batch)
+            p = subprocess.Popen(cmd, shell=True)
+            while p.poll() is None:
+                time.sleep(heartbeat)
+                if not self.queue.heartbeat(job['id'], attempt):
+                    logger.warning("[!] job %s: lost lease, aborting attempt %d" % (job['id'], attempt))
+                    p.kill()
+                    p.wait()
+                    return None
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+        if p.returncode == 0:
+            status = 'done'
+        elif p.returncode == EXIT_CANCELLED:
+            status = 'cancelled'
+        else:
+            status = 'failed'
+        self.queue.complete(job['id'], attempt, status, self.worker_id,
+                            returncode=p.returncode, started=started, target=job['target'])
+        logger.info("[+] job %s: %s (returncode %r)" % (job['id'], status, p.returncode))
+        return p.returncode
+
+    def run(self, exit_when_idle=False):
+        logger.info("[+] worker %s polling %r" % (self.worker_id, self.queue.path))
+        while True:
+            job, attempt = self.queue.claim(self.worker_id)
+            if job:
+                self.run_job(job, attempt)
+                continue
+            if exit_when_idle and not self.queue.pending():
+                logger.info("[+] worker %s: queue drained" % self.worker_id)
+                return
+            time.sleep(self.poll_interval)
+
+
+def main(argv):
+    logging.basicConfig(level=logging.DEBUG,
+                        format="[%(name)s/%(process)s][%(levelname)-10s] [%(module)s.%(funcName)-14s] %(message)s")
+    parser = OptionParser(usage="%prog worker|submit|status --queue=<dir> [options] [<target> -- [script args]]")
+    parser.add_option("-q", "--queue", dest="queue",
+                      help="shared queue directory")
+    parser.add_option("-i", "--ida-home", dest="ida_home",
+                      help="[worker] ida installation directory")
+    parser.add_option("-e", "--ida-exe", dest="ida_exe",
+                      help="[worker] ida executable, overrides --ida-home")
+    parser.add_option("-s", "--script", dest="script",
+                      help="[worker] path to ida_batch_decompile.py on this node")
+    parser.add_option("-p", "--poll-interval", dest="poll_interval", type="float", default=5.0,
+                      help="[worker] seconds between queue scans and lease heartbeats")
+    parser.add_option("-x", "--exit-when-idle", action="store_true", default=False,
+                      help="[worker] exit once no pending jobs are left")
+    parser.add_option("-t", "--lease-ttl", dest="lease_ttl", type="int", default=300,
+                      help="[submit] seconds until a lease without heartbeat expires")
+    parser.add_option("-6", "--ida64", action="store_true", default=False,
+                      help="[submit] run the job with ida64")
+    options, args = parser.parse_args(argv)
+    if not args or not options.queue:
+        parser.error("missing command or --queue")
+    command, args = args[0], args[1:]
+    queue = JobQueue(options.queue, lease_ttl=options.lease_ttl)
+
+    if command == 'worker':
+        if not (options.ida_home or options.ida_exe):
+            parser.error("worker requires --ida-home or --ida-exe")
+        JobQueueWorker(queue, ida_home=options.ida_home, ida_exe=options.ida_exe, script=options.script,
+                       poll_interval=options.poll_interval).run(exit_when_idle=options.exit_when_idle)
+    elif command == 'submit':
+        if not args:
+            parser.error("submit requires a target")
+        print(queue.submit(os.path.abspath(args[0]), args[1:], ida64=options.ida64))
+    elif command == 'status':
+        index = queue.lease_index()
+        for job_id in queue.jobs():
+            result = queue.result(job_id) or {}
+            attempts = queue.attempts(job_id, index)
+            status = result.get('status') or ('running' if attempts and not queue.lease_expired(job_id, attempts[-1])
+                                              else 'queued')
+            print("%s %-9s %s" % (job_id, status, (queue.job(job_id) or {}).get('target')))
+    else:
+        parser.error("unknown command %r" % command)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))